@@ -1,99 +1,267 @@
+import argparse
 import asyncio
-import aiohttp
+import collections
+import concurrent.futures
+import math
+import os
 import secrets
+import socket
 import time
 
-target_url = "http://localhost:3427"
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Use the IP directly to avoid DNS lookups for localhost
+target_host = "127.0.0.1"
+target_port = 3427
+
+# Large socket buffers, so a whole batch can be handed to the kernel in few syscalls
+SOCKET_BUFFER_SIZE = 4 << 20
+
+def build_request_head(host):
+    """Build the part of the request head that is the same for every batch, up to the length"""
+    return (
+        f"POST /add HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Content-Type: application/octet-stream\r\n"
+        f"Content-Length: "
+    ).encode()
+
+# Every request only differs in its body, so the head is built once per transport.
+# A Unix socket has no host and port, so it uses the generic localhost.
+TCP_REQUEST_HEAD = build_request_head(f"{target_host}:{target_port}")
+UDS_REQUEST_HEAD = build_request_head("localhost")
 
 def generate_hashes(count):
     """Precalculate all hashes before starting the benchmark"""
     print(f"Generating {count:,} random hashes...")
-    hashes = []
-    # Generate all random bytes at once
-    all_random_bytes = secrets.token_bytes(64 * count)
-    # Process in chunks of 64 bytes
-    for i in range(0, len(all_random_bytes), 64):
-        chunk = all_random_bytes[i:i+64]
-        hashes.append(chunk)
+    # Keep all hashes in one contiguous buffer, 64 bytes per hash
+    hashes = memoryview(bytearray(64 * count))
+
+    # Fill the buffer in parallel, the GIL is released while gathering random bytes
+    num_workers = os.cpu_count() or 1
+    chunk = max(1, math.ceil(count / num_workers)) * 64
+    def fill(start):
+        end = min(start + chunk, len(hashes))
+        hashes[start:end] = secrets.token_bytes(end - start)
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        list(executor.map(fill, range(0, len(hashes), chunk)))
 
     print(f"Hash generation complete!")
     return hashes
 
-async def send_batch_request(session, hashes_batch):
-    """Send a batch of hashes to the server as raw bytes"""
-    # Concatenate all hashes into a single byte array
-    batch_bytes = b''.join(hashes_batch)
+async def read_response(reader):
+    """Read a single HTTP/1.1 response and return its status code"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by server")
+    status = int(status_line.split(b" ", 2)[1])
+
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            content_length = int(value)
+
+    # Drain the body without decoding it, only the status is of interest
+    await reader.readexactly(content_length)
+    return status
+
+class PipelinedConnection:
+    """HTTP/1.1 connection with several requests in flight at once
+
+    Requests are written as soon as they are made. The server answers them in
+    order, so a reader task matches responses to requests via a FIFO of futures.
+    """
+
+    def __init__(self, uds_path=None):
+        self.uds_path = uds_path
+        self.request_head = TCP_REQUEST_HEAD if uds_path is None else UDS_REQUEST_HEAD
+        self.pending = collections.deque()
+        self.error = None
+        # Connect in the background so a broken connection can be replaced without awaiting
+        self.connected = asyncio.create_task(self._connect())
+
+    async def _connect(self):
+        if self.uds_path is not None:
+            # Unix domain sockets skip the TCP stack entirely, no tuning needed
+            self.reader, self.writer = await asyncio.open_unix_connection(self.uds_path)
+            self.reader_task = asyncio.create_task(self._read_responses())
+            return
+
+        # Configure the socket before connecting, so the buffer sizes apply to the TCP handshake
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, (target_host, target_port))
+        except BaseException:
+            sock.close()
+            raise
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.reader_task = asyncio.create_task(self._read_responses())
 
-    async with session.post(
-        f"{target_url}/add",
-        data=batch_bytes,
-        headers={"Content-Type": "application/octet-stream"}
-    ) as response:
-        return await response.json()
+    async def _read_responses(self):
+        try:
+            while True:
+                status = await read_response(self.reader)
+                self.pending.popleft().set_result(status)
+        except Exception as e:
+            # Fail everything still in flight, the connection can't be used anymore
+            self.error = e
+            while self.pending:
+                self.pending.popleft().set_exception(e)
 
-async def worker_batch(session, semaphore, hash_queue, completed_counter, batch_size=100):
-    """Worker that processes hashes in batches from the queue"""
+    async def request(self, head, body):
+        """Send a raw request and wait for the status code of its response"""
+        await self.connected
+        if self.error is not None:
+            raise ConnectionError(f"Connection is broken: {self.error}")
+        # The transport can be gone before the reader task notices, don't write into it
+        if self.writer.is_closing():
+            raise ConnectionError("Connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(head)
+        self.writer.write(body)
+        try:
+            await self.writer.drain()
+        except Exception:
+            # The reader task will fail the future too, but nobody is left to await it
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+        return await future
+
+    async def close(self):
+        """Close the connection, errors of a broken connection are ignored"""
+        try:
+            await self.connected
+        except Exception:
+            return
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+async def send_batch_request(connection, hashes, start, end):
+    """Send the hashes with index in [start, end) to the server as raw bytes"""
+    # A view into the contiguous hash buffer, the batch is never copied into a new object
+    batch_bytes = hashes[start*64:end*64]
+
+    head = connection.request_head + b"%d\r\n\r\n" % len(batch_bytes)
+    return await connection.request(head, batch_bytes)
+
+async def worker_batch(connections, retired, slot, hashes, next_batch, num_batches, batch_size, completed_counter):
+    """Worker that claims and sends batches over a shared pipelined connection until none are left"""
+    num_hashes = len(hashes) // 64
+    # Bind names used in the loop to locals to skip global lookups
+    send = send_batch_request
     while True:
-        # Collect a batch of hashes
-        batch = []
-        for _ in range(batch_size):
-            try:
-                hash_data = hash_queue.get_nowait()
-                batch.append(hash_data)
-            except asyncio.QueueEmpty:
-                break
-
-        if not batch:
+        # Claim the next batch, no locking needed as asyncio is single-threaded
+        i = next_batch[0]
+        if i >= num_batches:
             break
+        next_batch[0] += 1
+        start = i * batch_size
+        end = min(start + batch_size, num_hashes)
+
+        connection = connections[slot]
+        try:
+            status = await send(connection, hashes, start, end)
+            if status != 200:
+                print(f"Batch request failed with status {status}")
+            else:
+                completed_counter['count'] += end - start
+        except Exception as e:
+            print(f"Batch request failed: {e}")
+            # Replace the broken connection, unless another worker already did.
+            # It is closed after the run, so cleaning it up can't hold up this worker.
+            if connections[slot] is connection:
+                connections[slot] = PipelinedConnection(connection.uds_path)
+                retired.append(connection)
+
+async def print_progress(completed_counter, interval=1):
+    """Periodically print the number of completed requests and the current rate"""
+    while True:
+        await asyncio.sleep(interval)
+        elapsed = time.time() - completed_counter['start_time']
+        rate = completed_counter['count'] / elapsed
+        print(f"\rCompleted {completed_counter['count']} requests. Rate: {rate:.2f} req/sec", end="", flush=True)
+
+async def batch_requests(hashes, concurrent_limit, num_connections, batch_size=100, uds_path=None):
+    num_hashes = len(hashes) // 64
+    num_batches = math.ceil(num_hashes / batch_size)
+    # Index of the next batch to send, shared by all workers
+    next_batch = [0]
+
+    completed_counter = {'count': 0, 'start_time': time.time()}
+
+    # One worker per concurrent request, spread round-robin over the connections
+    connections = [PipelinedConnection(uds_path) for _ in range(num_connections)]
+    # Broken connections replaced during the run
+    retired = []
+    workers = [
+        worker_batch(connections, retired, k % num_connections, hashes, next_batch, num_batches, batch_size, completed_counter)
+        for k in range(concurrent_limit)
+    ]
+
+    # Report progress from a separate task to keep it out of the workers' loop
+    progress = asyncio.create_task(print_progress(completed_counter))
+
+    # Wait for all workers to complete
+    await asyncio.gather(*workers)
+    progress.cancel()
+    await asyncio.gather(*(connection.close() for connection in connections + retired))
+
+def positive_int(value):
+    """Argument type for options that need to be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
-        async with semaphore:
-            try:
-                await send_batch_request(session, batch)
-                completed_counter['count'] += len(batch)
-            except Exception as e:
-                # Fallback to individual requests if batch fails
-                print(f"Batch request failed: {e}")
-
-        if completed_counter['count'] % 10000 == 0:
-            elapsed = time.time() - completed_counter['start_time']
-            rate = completed_counter['count'] / elapsed
-            print(f"\rCompleted {completed_counter['count']} requests. Rate: {rate:.2f} req/sec", end="", flush=True)
-
-async def batch_requests(hashes, concurrent_limit, batch_size=100):
-    # Create a queue with all hashes
-    hash_queue = asyncio.Queue()
-    for hash_data in hashes:
-        hash_queue.put_nowait(hash_data)
-
-    async with aiohttp.ClientSession() as session:
-        semaphore = asyncio.Semaphore(concurrent_limit)
-        completed_counter = {'count': 0, 'start_time': time.time()}
-
-        # Create worker tasks that will process hashes in batches from the queue
-        workers = [
-            worker_batch(session, semaphore, hash_queue, completed_counter, batch_size)
-            for _ in range(concurrent_limit)
-        ]
-
-        # Wait for all workers to complete
-        await asyncio.gather(*workers)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the /add endpoint of the timestamping server")
+    parser.add_argument("--concurrency", type=positive_int, default=min(256, (os.cpu_count() or 1) * 32),
+                        help="number of concurrent requests (default: 32 per CPU core, at most 256)")
+    parser.add_argument("--connections", type=positive_int, default=os.cpu_count() or 1,
+                        help="number of connections the concurrent requests are pipelined over (default: one per CPU core)")
+    parser.add_argument("--uds", metavar="PATH",
+                        help="connect to a server on the same host via this Unix domain socket instead of TCP")
+    parser.add_argument("--batch-size", type=positive_int, default=10000, help="number of hashes per request")
+    parser.add_argument("--count", type=positive_int, default=5_000_000, help="total number of hashes to send")
+    return parser.parse_args()
 
 async def main():
-    concurrent_limit = 2
-    batch_size = 10000
+    args = parse_args()
+    concurrent_limit = args.concurrency
+    num_connections = min(args.connections, concurrent_limit)
+    batch_size = args.batch_size
 
     # Precalculate all hashes
-    hashes = generate_hashes(5_000_000)
+    num_hashes = args.count
+    hashes = generate_hashes(num_hashes)
 
-    print(f"Starting batch benchmark with {len(hashes):,} total requests, {concurrent_limit} concurrent, batch size {batch_size}...")
+    print(f"Starting batch benchmark with {num_hashes:,} total requests, {concurrent_limit} concurrent over {num_connections} connections, batch size {batch_size}...")
     start = time.time()
 
-    await batch_requests(hashes, concurrent_limit, batch_size=batch_size)
+    await batch_requests(hashes, concurrent_limit, num_connections, batch_size=batch_size, uds_path=args.uds)
 
     elapsed = time.time() - start
-    rate = len(hashes) / elapsed
+    rate = num_hashes / elapsed
     print(f"\nBatch mode completed in {elapsed:.2f} seconds")
     print(f"Average rate: {rate:.2f} requests/second")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Use the faster libuv based event loop if it is installed, uvloop.run needs uvloop 0.18+
+    run = getattr(uvloop, "run", None) or asyncio.run
+    run(main())
@@ -74,20 +74,72 @@ async fn main() {
         .layer(cors)
         .with_state(timestamping_service);
 
-    println!("Server starting on http://127.0.0.1:3427");
+    // Optionally serve on a Unix domain socket instead of TCP, e.g. `--uds /tmp/timestamping.sock`
+    let uds_path = uds_path_from_args();
+
+    match &uds_path {
+        Some(path) => println!("Server starting on unix:{}", path),
+        None => println!("Server starting on http://127.0.0.1:3427"),
+    }
     println!("POST /add - Add multiple 512-bit hashes (raw bytes, multiple of 64 bytes)");
     println!("POST /check - Check if hash exists and get merkle proof (raw bytes, 64 bytes)");
     println!("POST /update-tree - Update the merkle tree");
     println!("GET /stats - Get storage statistics");
     println!("Using {} threads for hash distribution", NUM_THREADS);
 
-    let listener = tokio::net::TcpListener::bind("127.0.0.1:3427")
-        .await
-        .unwrap();
+    if let Some(path) = uds_path {
+        serve_unix(app, &path).await;
+    } else {
+        let listener = tokio::net::TcpListener::bind("127.0.0.1:3427")
+            .await
+            .unwrap();
+        axum::serve(listener, app).await.unwrap();
+    }
+}
 
+/// Socket path given with `--uds <path>`, exits if the path is missing or the platform has no Unix sockets
+fn uds_path_from_args() -> Option<String> {
+    let mut args = std::env::args().skip_while(|arg| arg != "--uds");
+    args.next()?;
+    if cfg!(not(unix)) {
+        eprintln!("--uds is only supported on Unix");
+        std::process::exit(2);
+    }
+    match args.next() {
+        Some(path) => Some(path),
+        None => {
+            eprintln!("--uds requires a socket path");
+            std::process::exit(2);
+        }
+    }
+}
+
+#[cfg(unix)]
+async fn serve_unix(app: Router, path: &str) {
+    use std::os::unix::fs::FileTypeExt;
+
+    // Only remove a stale socket left over from a previous run, never any other file or a live socket
+    if let Ok(metadata) = std::fs::symlink_metadata(path) {
+        if !metadata.file_type().is_socket() {
+            eprintln!("{} already exists and is not a socket", path);
+            std::process::exit(1);
+        }
+        if std::os::unix::net::UnixStream::connect(path).is_ok() {
+            eprintln!("{} is in use by another server", path);
+            std::process::exit(1);
+        }
+        std::fs::remove_file(path).unwrap();
+    }
+
+    let listener = tokio::net::UnixListener::bind(path).unwrap();
     axum::serve(listener, app).await.unwrap();
 }
 
+#[cfg(not(unix))]
+async fn serve_unix(_app: Router, _path: &str) {
+    unreachable!("--uds is rejected on platforms without Unix sockets")
+}
+
 async fn add(
     State(service): State<Arc<TimestampingService<INDEX_SIZE, PREFIX_SIZE>>>,
     bytes: Bytes,